@@ -18,6 +18,7 @@
 from __future__ import unicode_literals
 
 import re
+import sys
 from collections import namedtuple
 
 __all__ = [
@@ -175,7 +176,9 @@ def _line_type(name, field_names, format_string):
 
     """
     lt = namedtuple(name, field_names)
-    lt.type = name.lower()
+    # Interned, so that comparisons with type literals elsewhere in the code
+    # succeed on the identity check without comparing characters.
+    lt.type = sys.intern(name.lower())
     lt.to_string = lambda self: format_string.format(self)
     lt.to_dict = _to_dict
     return lt
@@ -26,6 +26,19 @@ from .renderer import render_filterlist, IncludeError, MissingHeader
 __all__ = ["main"]
 
 
+def _jobs(value):
+    """Parse the number of parallel jobs (0 or a positive integer)."""
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = -1
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(
+            "expected 0 or a positive integer, got '{}'".format(value)
+        )
+    return jobs
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Render a filter list.")
     parser.add_argument(
@@ -45,6 +58,15 @@ def parse_args():
         metavar="NAME=PATH",
         help="define include path (could be given multiple times)",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=8,
+        metavar="N",
+        help="fetch up to N included files in parallel, 0 fetches them one "
+        "by one when needed (default: 8)",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -70,13 +92,14 @@ def main():
         sources[name] = FSSource(path)
 
     try:
-        lines = render_filterlist(args.infile, sources, TopSource())
+        lines = render_filterlist(
+            args.infile, sources, TopSource(), max_workers=args.jobs,
+        )
+        text = (line.to_string() + "\n" for line in lines)
         if args.outfile == "-":
-            for line in lines:
-                sys.stdout.write(line.to_string() + "\n")
+            sys.stdout.writelines(text)
         else:
             with io.open(args.outfile, "w", encoding="utf-8") as out_fp:
-                for line in lines:
-                    out_fp.write(line.to_string() + "\n")
+                out_fp.writelines(text)
     except (MissingHeader, NotFound, IncludeError) as exc:
         sys.exit(exc)
@@ -17,9 +17,9 @@
 
 from __future__ import unicode_literals
 
-import itertools
 import logging
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from .parser import parse_filterlist, Comment, Metadata
 from .sources import NotFound
@@ -33,8 +33,10 @@ class IncludeError(Exception):
     """Error in processing include instruction."""
 
     def __init__(self, error, stack):
-        stack_str = " from ".join(map("'{}'".format, reversed(stack)))
-        if stack_str:
+        if len(stack) == 1:
+            error = "{} when including '{}'".format(error, stack[0])
+        elif stack:
+            stack_str = " from ".join("'%s'" % name for name in reversed(stack))
             error = "{} when including {}".format(error, stack_str)
         Exception.__init__(self, error)
 
@@ -43,14 +45,14 @@ class MissingHeader(Exception):
     """First line of the result is not a valid header."""
 
 
-def _get_and_parse_fragment(name, sources, default_source, include_stack=[]):
-    """Retrieve and parse fragment.
+def _resolve_fragment(name, sources, default_source, include_stack=[]):
+    """Find the source of a fragment.
 
     Returns
     -------
-    tuple (iterator of str, Source)
-        First part is the content of the fragment line by line; second part is
-        the default source to be used for included fragments.
+    tuple (Source, str)
+        The source that contains the fragment and the name of the fragment
+        inside of that source.
 
     """
     if ":" in name:
@@ -67,86 +69,213 @@ def _get_and_parse_fragment(name, sources, default_source, include_stack=[]):
     if source is None:
         raise IncludeError("Source name is absent in: '{}'".format(name), include_stack)
 
-    return (
-        parse_filterlist(source.get(name_in_source)),
-        source if source.is_inheritable else None,
+    return source, name_in_source
+
+
+def _fetch_fragment(source, name_in_source):
+    """Read all lines of a fragment (safe to run in a worker thread)."""
+    return list(source.get(name_in_source))
+
+
+class _FragmentCache(object):
+    """Parsed fragments used during one rendering.
+
+    Each fragment is fetched and parsed at most once, even if it's included
+    several times. If `executor` is given, the fragments included by a
+    fragment are fetched in the background as soon as it's parsed.
+    """
+
+    def __init__(self, sources, executor=None):
+        self._sources = sources
+        self._executor = executor
+        self._fragments = {}
+
+    def prefetch(self, source, name_in_source):
+        """Start fetching the fragment in the background (if possible)."""
+        key = (source, name_in_source)
+        if self._executor is not None and key not in self._fragments:
+            self._fragments[key] = self._executor.submit(
+                _fetch_fragment, source, name_in_source,
+            )
+
+    def prefetch_includes(self, lines, default_source):
+        """Start fetching fragments included by `lines` in the background.
+
+        Includes that can't be resolved are skipped here, the error will be
+        reported when the include is actually processed.
+        """
+        if self._executor is None:
+            return
+        for line in lines:
+            if line.type != "include":
+                continue
+            try:
+                source, name_in_source = _resolve_fragment(
+                    line.target, self._sources, default_source,
+                )
+            except IncludeError:
+                continue
+            self.prefetch(source, name_in_source)
+
+    def get_or_parse(self, source, name_in_source):
+        """Return the parsed lines of the fragment."""
+        key = (source, name_in_source)
+        fragment = self._fragments.get(key)
+        if isinstance(fragment, tuple):
+            return fragment
+
+        if fragment is None:
+            content = source.get(name_in_source)
+        else:
+            content = fragment.result()
+        fragment = tuple(parse_filterlist(content))
+        self._fragments[key] = fragment
+        self.prefetch_includes(
+            fragment, source if source.is_inheritable else None,
+        )
+        return fragment
+
+    def close(self):
+        """Cancel background fetches that haven't started yet."""
+        for fragment in self._fragments.values():
+            if isinstance(fragment, Future):
+                fragment.cancel()
+
+
+def _get_and_parse_fragment(name, sources, default_source, include_stack=[],
+                            cache=None):
+    """Retrieve and parse fragment.
+
+    If `cache` (a `_FragmentCache`) is given, the fragment is taken from it.
+
+    Returns
+    -------
+    tuple (tuple of namedtuple, Source)
+        First part is the parsed content of the fragment line by line; second
+        part is the default source to be used for included fragments.
+
+    """
+    source, name_in_source = _resolve_fragment(
+        name, sources, default_source, include_stack,
     )
 
+    if cache is None:
+        lines = tuple(parse_filterlist(source.get(name_in_source)))
+    else:
+        lines = cache.get_or_parse(source, name_in_source)
+
+    return lines, source if source.is_inheritable else None
+
+
+def _process_includes(
+    sources, default_source, parent_include_stack, lines, max_workers=None,
+):
+    """Replace include instructions with the lines of included fragment.
+
+    Nested includes are walked with an explicit stack of iterators instead of
+    recursive generators, so the cost per line doesn't depend on how deeply
+    the fragment is nested. The names of the fragments being included are
+    kept as a list (for error messages) and as a set (for fast loop
+    detection), both updated in place when entering and leaving fragments.
+
+    Fragments that are included several times are only loaded once. If
+    `max_workers` is given, the fragments included by each fragment are
+    fetched in that many background threads as soon as the including
+    fragment is loaded.
+    """
+    executor = None
+    if max_workers:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    cache = _FragmentCache(sources, executor)
+    cache.prefetch_includes(lines, default_source)
+
+    include_stack = list(parent_include_stack)
+    include_set = set(include_stack)
+    try:
+        stack = [(iter(lines), default_source)]
+        while stack:
+            frame_lines, source = stack[-1]
+            is_top = len(stack) == 1
+
+            # Pass through lines of the current fragment in a tight loop until
+            # we hit an include or run out of lines.
+            for line in frame_lines:
+                line_type = line.type
+                if line_type == "include":
+                    break
+                if is_top or line_type not in {"header", "metadata"}:
+                    yield line
+            else:
+                stack.pop()
+                if not is_top:
+                    include_set.remove(include_stack.pop())
+                continue
 
-def _process_includes(sources, default_source, parent_include_stack, lines):
-    """Replace include instructions with the lines of included fragment."""
-    for line in lines:
-        if line.type == "include":
             name = line.target
-            include_stack = parent_include_stack + [name]
-            if name in parent_include_stack:
+            include_stack.append(name)
+            if name in include_set:
                 raise IncludeError("Include loop encountered", include_stack)
+            include_set.add(name)
 
             try:
                 included, inherited_source = _get_and_parse_fragment(
-                    name, sources, default_source, include_stack
-                )
-                all_included = _process_includes(
-                    sources, inherited_source, include_stack, included
+                    name, sources, source, include_stack, cache,
                 )
-
-                _logger.info("- including: %s", name)
-                yield Comment("*** {} ***".format(name))
-                for line in all_included:
-                    if line.type not in {"header", "metadata"}:
-                        yield line
             except (NotFound, ValueError) as exc:
                 raise IncludeError(exc, include_stack)
-        else:
-            yield line
-
-
-def _process_timestamps(lines):
-    """Convert timestamp markers into actual timestamps."""
-    for line in lines:
-        if line.type == "metadata" and line.value == "%timestamp%":
-            timestamp = time.strftime("%d %b %Y %H:%M UTC", time.gmtime())
-            yield Metadata(line.key, timestamp)
-        else:
-            yield line
-
 
-def _first_and_rest(iterable):
-    """Return the first item from the iterable and the rest as an iterator."""
-    iterator = iter(iterable)
-    first_item = next(iterator)
-    return first_item, iterator
+            _logger.info("- including: %s", name)
+            yield Comment("*** {} ***".format(name))
+            stack.append((iter(included), inherited_source))
+    finally:
+        # When rendering fails or is abandoned, don't leave queued fetches
+        # behind: they would delay the exit of the interpreter.
+        if executor is not None:
+            cache.close()
+            executor.shutdown(wait=False)
 
 
-def _insert_version(lines):
-    """Insert metadata comment with version (a.k.a. date)."""
-    first_line, rest = _first_and_rest(lines)
-    version = Metadata("Version", time.strftime("%Y%m%d%H%M", time.gmtime()))
-    return itertools.chain([first_line, version], rest)
+def _finalize(lines):
+    """Insert version, process timestamps and checksums.
 
-
-def _remove_checksum(lines):
-    """Remove metadata comments giving a checksum.
+    All post-processing happens in one pass over the lines to avoid stacking
+    a generator per step. Timestamp markers are converted into actual
+    timestamps and metadata comments giving a checksum are removed.
 
     Adblock Plus is no longer verifying checksums, so we don't have to
     calculate the checksum for the resulting filter list. But we have
     to strip them for compatibility with older versions of Adblock Plus
     and other ad blockers which might still verify a checksum if given.
+
+    The first line must be the header (see `render_filterlist`). When this
+    generator is closed, `lines` is closed too, so that the include processing
+    can stop its background fetches right away.
     """
-    for line in lines:
-        if line.type != "metadata" or line.key.lower() != "checksum":
+    try:
+        lines_iter = iter(lines)
+        first_line = next(lines_iter)
+
+        # Use the same time for the version and all timestamps in the list.
+        now = time.gmtime()
+        timestamp = time.strftime("%d %b %Y %H:%M UTC", now)
+        yield first_line
+        yield Metadata("Version", time.strftime("%Y%m%d%H%M", now))
+
+        for line in lines_iter:
+            if line.type == "metadata":
+                key = line.key
+                if key.lower() == "checksum":
+                    continue
+                if line.value == "%timestamp%":
+                    line = Metadata(key, timestamp)
             yield line
+    finally:
+        close = getattr(lines, "close", None)
+        if close is not None:
+            close()
 
 
-def _validate(lines):
-    """Validate the final list."""
-    first_line, rest = _first_and_rest(lines)
-    if first_line.type != "header":
-        raise MissingHeader("No header found at the beginning of the input.")
-    return itertools.chain([first_line], rest)
-
-
-def render_filterlist(name, sources, top_source=None):
+def render_filterlist(name, sources, top_source=None, max_workers=None):
     """Produce filter list from fragments.
 
     Parameters
@@ -157,6 +286,10 @@ def render_filterlist(name, sources, top_source=None):
         Sources for loading included fragments.
     top_source : Source
         The source used to load the top level fragment.
+    max_workers : int
+        Number of threads for fetching included fragments in the background
+        (default: None, fetch them one by one when they are needed). Useful
+        when the fragments come from slow sources, such as the web.
 
     Returns
     -------
@@ -176,10 +309,15 @@ def render_filterlist(name, sources, top_source=None):
     """
     _logger.info("Rendering: %s", name)
     lines, default_source = _get_and_parse_fragment(name, sources, top_source)
-    lines = _process_includes(sources, default_source, [name], lines)
-    for proc in [_process_timestamps, _insert_version, _remove_checksum, _validate]:
-        lines = proc(lines)
-    return lines
+    # Validate before any rendering happens, so that invalid input fails
+    # right away instead of during iteration.
+    if not lines or lines[0].type != "header":
+        raise MissingHeader("No header found at the beginning of the input.")
+
+    lines = _process_includes(
+        sources, default_source, [name], lines, max_workers,
+    )
+    return _finalize(lines)
 
 
 def _split_list_for_diff(list_in):
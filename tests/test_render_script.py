@@ -146,6 +146,25 @@ def test_render_with_includes_relative(rootdir, dstfile):
     assert "I am included!" in dstfile.read()
 
 
+@pytest.mark.parametrize("jobs", ["0", "1", "4"])
+def test_render_jobs(rootdir, dstfile, jobs):
+    code, _, _ = run_script(
+        "includer.txt", str(dstfile), "-i", "inc=inc", "-j", jobs, cwd=str(rootdir)
+    )
+    assert code == 0
+    assert "I am included!" in dstfile.read()
+
+
+@pytest.mark.parametrize("jobs", ["-1", "x"])
+def test_invalid_jobs(rootdir, dstfile, jobs):
+    code, err, _ = run_script(
+        "includer.txt", str(dstfile), "-j", jobs, cwd=str(rootdir)
+    )
+    assert code == 2
+    assert "argument -j/--jobs: expected 0 or a positive integer" in err
+    assert "Traceback" not in err
+
+
 def test_render_verbose(rootdir, dstfile):
     code, err, _ = run_script(
         "includer.txt", str(dstfile), "-i", "inc=inc", "-v", cwd=str(rootdir)
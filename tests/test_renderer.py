@@ -17,9 +17,12 @@ from __future__ import unicode_literals
 
 import pytest
 import mock
+import threading
 import time
 
 from abp.filters import render_filterlist, MissingHeader, IncludeError
+from abp.filters import renderer
+from abp.filters.sources import NotFound
 
 
 @pytest.fixture()
@@ -46,7 +49,25 @@ class MockSource(object):
         self.files = kw
 
     def get(self, filename):
-        return self.files[filename].split("\n")
+        try:
+            return self.files[filename].split("\n")
+        except KeyError:
+            raise NotFound("File not found: '{}'".format(filename))
+
+
+class SlowSource(MockSource):
+    """Source that blocks fetching of included files until released."""
+
+    def __init__(self, **kw):
+        super(SlowSource, self).__init__(**kw)
+        self.release = threading.Event()
+        self.fetched = []
+
+    def get(self, filename):
+        if filename != "fl":
+            self.fetched.append(filename)
+            self.release.wait(5)
+        return super(SlowSource, self).get(filename)
 
 
 def render_str(*args, **kw):
@@ -73,6 +94,86 @@ def test_include2(head):
     assert got.startswith(expect)
 
 
+def test_prefetch_includes(head):
+    src1 = MockSource(fl="[Adblock]\n%include inc1%\n%include src2:inc2%")
+    src2 = MockSource(inc2="%include inc3%\n%include inc1%", inc3="3", inc1="1")
+    src1.files["inc1"] = "%include src2:inc1%"
+    sources = {"src1": src1, "src2": src2}
+    got = render_str("src1:fl", sources, max_workers=4)
+    assert got == render_str("src1:fl", sources)
+    assert got == head + (
+        "! *** inc1 ***\n! *** src2:inc1 ***\n1\n"
+        "! *** src2:inc2 ***\n! *** inc3 ***\n3\n! *** inc1 ***\n1"
+    )
+
+
+def test_prefetch_missing_include():
+    src = MockSource(fl="[Adblock]\n%include inc1%", inc1="%include missing%")
+    with pytest.raises(IncludeError) as exc_info:
+        render_str("fl", {}, src, max_workers=4)
+    assert "'missing' from 'inc1'" in str(exc_info.value)
+
+
+def test_failed_render_cancels_prefetch():
+    includes = "\n".join("%include inc{}%".format(i) for i in range(10))
+    src = SlowSource(fl="[Adblock]\n%include missing:inc%\n" + includes)
+    threads_before = set(threading.enumerate())
+    try:
+        with pytest.raises(IncludeError):
+            render_str("fl", {}, src, max_workers=1)
+    finally:
+        src.release.set()
+    for thread in set(threading.enumerate()) - threads_before:
+        thread.join(5)
+    # Only the fetch that was already running when rendering failed is done.
+    assert len(src.fetched) <= 1
+
+
+def test_abandoned_render_cancels_prefetch():
+    includes = "\n".join("%include inc{}%".format(i) for i in range(10))
+    src = SlowSource(fl="[Adblock]\n" + includes)
+    # Keep references to the include processing generators, so that they
+    # aren't finalized by the garbage collector when the render is closed.
+    inner = []
+    process_includes = renderer._process_includes
+
+    def keep_process_includes(*args, **kw):
+        inner.append(process_includes(*args, **kw))
+        return inner[-1]
+
+    threads_before = set(threading.enumerate())
+    with mock.patch.object(renderer, "_process_includes", keep_process_includes):
+        lines = render_filterlist("fl", {}, src, max_workers=1)
+    next(lines)
+    lines.close()
+    src.release.set()
+    for thread in set(threading.enumerate()) - threads_before:
+        thread.join(5)
+    assert len(src.fetched) <= 1
+
+
+def test_repeated_include_loaded_once(head):
+    src = MockSource(fl="[Adblock]\n%include inc%\n%include inc%", inc="Included")
+    src.get = mock.Mock(side_effect=src.get)
+    got = render_str("fl", {}, src)
+    assert got == head + "! *** inc ***\nIncluded\n! *** inc ***\nIncluded"
+    assert [c.args for c in src.get.call_args_list] == [("fl",), ("inc",)]
+
+
+def test_repeated_include_scanned_once(head):
+    src = MockSource(
+        fl="[Adblock]\n%include inc%\n%include inc%\n%include inc%",
+        inc="Included",
+    )
+    with mock.patch.object(
+        renderer._FragmentCache, "prefetch_includes", autospec=True,
+        side_effect=renderer._FragmentCache.prefetch_includes,
+    ) as prefetch_includes:
+        render_str("fl", {}, src, max_workers=2)
+    # Once for the top level fragment and once when "inc" is parsed.
+    assert prefetch_includes.call_count == 2
+
+
 def test_circular_includes():
     src = MockSource(fl="[Adblock]\n%include src:fl%")
     with pytest.raises(IncludeError):
@@ -85,6 +186,13 @@ def test_timestamp(gmtime):
     assert time.strftime("Last modified: %d %b %Y %H:%M UTC", gmtime()) in got
 
 
+def test_timestamp_computed_once(gmtime):
+    src = MockSource(fl="[Adblock]\n! Created: %timestamp%\n! Updated: %timestamp%")
+    gmtime.reset_mock()
+    render_str("fl", {}, src)
+    assert gmtime.call_count == 1
+
+
 def test_wrong_source():
     src = MockSource(fl="[Adblock]\n%include missing:fl%")
     with pytest.raises(IncludeError):
@@ -118,7 +226,44 @@ def test_missing_header():
         render_str("fl", {}, src)
 
 
+def test_missing_header_raised_on_call():
+    src = MockSource(fl="! No header")
+    with pytest.raises(MissingHeader):
+        render_filterlist("fl", {}, src)
+
+
+def test_include_as_first_line():
+    src = MockSource(fl="%include inc%\n[Adblock]", inc="[Adblock]")
+    with pytest.raises(MissingHeader):
+        render_filterlist("fl", {}, src)
+
+
 def test_remove_checksum(head):
     src = MockSource(fl="[Adblock]\n! Comment\n! Checksum: foo")
     got = render_str("fl", {}, src)
     assert got == head + "! Comment"
+
+
+def test_empty_list():
+    src = MockSource(fl="")
+    with pytest.raises(MissingHeader):
+        render_str("fl", {}, src)
+
+
+def test_deeply_nested_includes():
+    depth = 2000
+    fragments = {"inc{}".format(i): "%include inc{}%".format(i + 1)
+                 for i in range(depth)}
+    fragments["inc{}".format(depth)] = "Included"
+    src = MockSource(fl="[Adblock]\n%include inc0%", **fragments)
+    got = render_str("fl", {}, src)
+    assert got.endswith("! *** inc{} ***\nIncluded".format(depth))
+
+
+@pytest.mark.parametrize("stack,expected", [
+    ([], "Oops"),
+    (["a"], "Oops when including 'a'"),
+    (["a", "b", "c"], "Oops when including 'c' from 'b' from 'a'"),
+])
+def test_include_error_message(stack, expected):
+    assert str(IncludeError("Oops", stack)) == expected